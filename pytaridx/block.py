@@ -3,11 +3,32 @@
 
 # SPDX-License-Identifier: MIT
 
-import hashlib
+import binascii
 import json
+import mmap
 import re
 import time
 
+from hashlib import sha256 as _sha256
+
+# Item lists are stored one record per line, with fields separated by
+# commas. Commas and backslashes within a field are escaped by a
+# backslash.
+_FIELDPAT = re.compile(b"(\\\\.|[^,])*(,|\n)")
+_UNESCAPEPAT = re.compile(b'\\\\(.)')
+
+
+def _splitfields(line):
+    # Only lines that actually contain escapes need the regex scanner;
+    # everything else is a plain split on commas.
+    if b"\\" not in line:
+        return line.split(b",")
+    return [
+        _UNESCAPEPAT.sub(br'\1', x.group()[:-1])
+        for x in _FIELDPAT.finditer(line + b"\n")
+    ]
+
+
 # The Block class implements a block that can hold key-value pairs and
 # a list of items (name,offset,size). Each block is protected by a
 # sha256 hashsum to ensure data integrity. When used as a main
@@ -19,70 +40,101 @@ class Block:
     dataoffset = -1
 
     header = ""
+    hashblank = b""
+    blankimages = {}
+    emptyimages = {}
 
-    def __init__(self, filehandle, blksize, blkno):
+    def __init__(self, filehandle, blksize, blkno, verify=True):
         self.blocksize = blksize
         self.blkno = blkno
 
         if Block.hashsize < 0:
             # print("Initializing Block global data")
-            m = hashlib.sha256()
+            m = _sha256()
             Block.hashsize = 2 * m.digest_size
+            Block.hashblank = b" " * Block.hashsize
             Block.header = "hash = " + " " * Block.hashsize + "\n"
             Block.hashoffset = 7
             Block.dataoffset = len(Block.header)
 
         if filehandle is None:
-            self.data = bytearray(
-                Block.header + "\x00" * (self.blocksize - Block.dataoffset),
-                encoding="ASCII"
-            )
-            info = "end\n"
-            p = Block.dataoffset
-            self.data[p:(p + len(info))] = info
-            self.makehash()
+            # An empty block is the same every time (for a given block
+            # size), so it is only built and hashed once.
+            image = Block.emptyimages.get(self.blocksize)
+            if image is None:
+                self.data = Block.blankimage_(self.blocksize)
+                info = b"end\n"
+                p = Block.dataoffset
+                self.data[p:(p + len(info))] = info
+                self.makehash()
+                Block.emptyimages[self.blocksize] = bytes(self.data)
+            else:
+                self.data = bytearray(image)
+            self.valid = True
+            return
         elif type(filehandle) == dict:
-            self.data = bytearray(
-                Block.header + "\x00" * (self.blocksize - Block.dataoffset),
-                encoding="ASCII"
-            )
-            self.assign(filehandle)
+            self.data = Block.blankimage_(self.blocksize)
+            # assign() has just hashed the block, no need to check it
+            self.valid = self.assign(filehandle)
+            return
         else:
             offset = self.blkno * self.blocksize
-            filehandle.seek(offset)
-            self.data = bytearray(filehandle.read(self.blocksize))
+            if type(filehandle) == mmap.mmap:
+                # Copy straight out of the mapped file
+                view = memoryview(filehandle)
+                self.data = bytearray(view[offset:(offset + self.blocksize)])
+                view.release()
+            else:
+                filehandle.seek(offset)
+                self.data = bytearray(filehandle.read(self.blocksize))
+            if not verify:
+                # The caller checks the hash itself (if needed)
+                self.valid = None
+                return
 
         self.valid = self.checkhash()
 
-    def checkhash(self):
-        m = hashlib.sha256()
+    @classmethod
+    def blankimage_(cls, blocksize):
+        # Empty block (header followed by zeros). One template is kept
+        # per block size, and each new block gets a copy of it.
+        image = cls.blankimages.get(blocksize)
+        if image is None:
+            image = bytes(
+                cls.header + "\x00" * (blocksize - cls.dataoffset),
+                encoding="ASCII"
+            )
+            cls.blankimages[blocksize] = image
+        return bytearray(image)
+
+    def hashdigest_(self):
+        # Hash of the block as if the hash field were blank. The
+        # blank field is fed to the hasher in place of the stored
+        # one, so self.data is never modified (and concurrent readers
+        # of a block are safe).
         start = Block.hashoffset
         end = Block.hashoffset + Block.hashsize
 
-        hash1 = self.data[start:end]
-        self.data[start:end] \
-            = bytearray(" " * Block.hashsize, encoding="ASCII")
-        m.update(self.data)
-        hash2 = bytearray(m.hexdigest(), encoding="ASCII")
-        self.data[start:end] = hash1
+        view = memoryview(self.data)
+        m = _sha256(view[:start])
+        m.update(Block.hashblank)
+        m.update(view[end:])
+        # The hash is stored hex encoded in the block. hexlify encodes
+        # the raw digest straight to bytes (no str in between).
+        return binascii.hexlify(m.digest())
+
+    def checkhash(self):
+        start = Block.hashoffset
+        end = Block.hashoffset + Block.hashsize
 
-        # print("Hash check:")
-        # print("  ", hash1)
-        # print("  ", hash2)
-        # print("h1 == h2: ", hash1 == hash2)
-        # return cmp(hash1, hash2) == 0
-        return bool(hash1 == hash2)
+        with memoryview(self.data) as view:
+            return bool(view[start:end] == self.hashdigest_())
 
     def makehash(self):
-        m = hashlib.sha256()
         start = Block.hashoffset
         end = Block.hashoffset + Block.hashsize
 
-        self.data[start:end] = \
-            bytearray(" " * Block.hashsize, encoding="ASCII")
-        m.update(self.data)
-        hash = m.hexdigest()
-        self.data[start:end] = bytearray(hash, encoding="ASCII")
+        self.data[start:end] = self.hashdigest_()
 
     def printblock(self):
         for line in self.data.splitlines():
@@ -94,11 +146,6 @@ class Block:
         items = {}
         listmode = False
 
-        pat = b"(\\\\.|[^,])*(,|\n)"
-        patc = re.compile(pat)
-        spat = b'\\\\(.)'
-        spatc = re.compile(spat)
-
         for line in self.data.splitlines():
             if listmode:
                 # print("line = ", line + b"\n")
@@ -106,10 +153,7 @@ class Block:
                     items[curname] = curlist
                     listmode = False
                 else:
-                    elems = [
-                        spatc.sub(b'\1', x.group()[:-1])
-                        for x in patc.finditer(line + b"\n")
-                    ]
+                    elems = _splitfields(line)
                     elems[0] = elems[0].decode("ASCII")
                     for i in range(1, len(elems)):
                         elems[i] = int(elems[i])
@@ -130,42 +174,50 @@ class Block:
         return items
 
     @classmethod
-    def assignstring_(cls, items):
-        rec = re.compile("(,|\\\\)")
+    def rowbytes_(cls, row):
+        # One serialized item list record (without newline). Integers
+        # (offsets, sizes, block numbers) never need escaping; other
+        # columns are escaped after encoding, at the bytes level.
+        return b",".join([
+            b"%d" % col if type(col) == int else
+            str(col).encode("ASCII")
+            .replace(b"\\", b"\\\\").replace(b",", b"\\,")
+            for col in row
+        ])
 
-        def serialize(rhs):
+    @classmethod
+    def assignbytes_(cls, items):
+        # Serializes items directly into one growing buffer; returns
+        # the block payload (everything after the header).
+        buf = bytearray()
+        for k in items:
+            rhs = items[k]
+            buf += k.encode("ASCII")
+            buf += b" = "
             if type(rhs) == list:
-                if len(rhs) > 0:
-                    return "{\n" + \
-                        "\n".join(
-                            [",".join(
-                                [rec.sub(r'\\\1', str(col))
-                                    for col in row])
-                                for row in rhs]) \
-                        + "\n}"
-                else:
-                    return "{\n}"
+                buf += b"{\n"
+                for row in rhs:
+                    buf += cls.rowbytes_(row)
+                    buf += b"\n"
+                buf += b"}\n"
             else:
-                return "%d" % rhs
-
-        return "\n".join(
-            ["%s = %s" % (k, serialize(items[k])) for k in items]) \
-            + "\nend\n"
+                buf += b"%d\n" % rhs
+        buf += b"end\n"
+        return buf
 
     def assign(self, items):
         pos = Block.dataoffset
 
-        itemstr = Block.assignstring_(items)
-        n = len(itemstr)
+        itembytes = Block.assignbytes_(items)
+        n = len(itembytes)
         if Block.dataoffset + n > self.blocksize:
             # raise Exception("Item array to large to fit in block")
             return False
         else:
-            self.data[pos:(pos + n)] = bytearray(itemstr, encoding="ASCII")
+            self.data[pos:(pos + n)] = itembytes
             self.makehash()
             return True
 
-
 if __name__ == "__main__":
 
     items = {
@@ -231,7 +283,7 @@ if __name__ == "__main__":
 
     t7 = time.time()
     for i in range(niter):
-        s = Block.assignstring_(items)
+        s = Block.assignbytes_(items)
     t8 = time.time()
     ss = s
 
@@ -3,10 +3,27 @@
 
 # SPDX-License-Identifier: MIT
 
+import bisect
+import collections
+import mmap
+import operator
 import os
 
 from .block import Block
 
+
+def _writeall(fd, bufs):
+    # Writes the buffers, in order, at the current position of fd (or
+    # at the end of the file, in append mode). This is a single writev,
+    # unless the system writes less than everything.
+    n = os.writev(fd, bufs)
+    if n < sum([len(b) for b in bufs]):
+        # Short write; write out the rest
+        rest = memoryview(b"".join(bufs))[n:]
+        while len(rest) > 0:
+            rest = rest[os.write(fd, rest):]
+
+
 ## The BlockTree class implements a b-tree like data structure to
 ## maintain an index (each item is a (name,offset,size) triplet. The
 ## index is kept on disk using the Block data structure (from
@@ -14,21 +31,38 @@ from .block import Block
 ## versions) do allow some defense against data curruption. This
 ## interface supports multiple readers concurrent with up to one
 ## writer.
+##
+## Block hashes are checked on every block read by default
+## (verify=True). On storage that already guarantees data integrity,
+## verify=False skips the check (a block is then trusted based on its
+## sequence number alone), and verify="sample" checks only every
+## verifyinterval'th block read.
 class BlockTree:
-    def __init__(self, filename, mode, cacheflag=False, allowoverwrite=True):
-        self.backing = self.BlockFile(filename, mode, cacheflag)
+    def __init__(self, filename, mode, cacheflag=False, allowoverwrite=True,
+                 verify=True):
+        self.backing = self.BlockFile(filename, mode, cacheflag, verify)
         self.backing.overwriteflag = allowoverwrite
         items = self.backing.readblock(1)
         self.root = self.Node(self.backing, items)
 
     class BlockFile:
         masterblocksize = 512
+        blockcachesize = 1024
+        # Max number of blocks written by one writev (must not exceed
+        # the system's IOV_MAX, which is at least 1024 on Linux)
+        writevmax = 512
+        verifyinterval = 16
 
-        def __init__(self, filename, mode, cacheflag):
+        def __init__(self, filename, mode, cacheflag, verify=True):
             self.filename = filename
             self.mode = mode
             self.cacheflag = cacheflag
+            self.verify = verify
+            self.readcount = 0
             self.dirtymap = {}
+            # LRU cache of recently read or written blocks:
+            # blockno -> (items, seqno, slot of newest copy)
+            self.blockcache = collections.OrderedDict()
 
             if mode == "r":
                 self.readonly = True
@@ -39,6 +73,11 @@ class BlockTree:
                     "BlockTree: Unknown open mode '{}' for file '{}'"
                     .format(filename, mode)
                 )
+            if verify not in (True, False, "sample"):
+                raise Exception(
+                    "BlockTree: Unknown verify option '{}' for file '{}'"
+                    .format(verify, filename)
+                )
 
             self.filehandle = open(filename, mode + "b")
             self.readmasterblock()
@@ -56,6 +95,24 @@ class BlockTree:
             self.lastblock = (self.freeblock - 1)//2
             self.freeblock = self.lastblock + 1
 
+            # Blocks are read through a (read-only) memory map of the
+            # file; writes still go through filehandle.
+            self.mmap = None
+            self.mapfile_()
+
+        def mapfile_(self):
+            if self.mmap is not None:
+                self.mmap.close()
+            self.mmap = mmap.mmap(
+                self.filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def mapped_(self, slot):
+            # The memory map, remapped first if block slot lies beyond
+            # its end (i.e. the file has grown since it was mapped).
+            if (slot + 1) * self.blocksize > len(self.mmap):
+                self.mapfile_()
+            return self.mmap
+
         def allocateblock(self):
             blk = self.freeblock
             self.freeblock = blk + 1
@@ -115,8 +172,10 @@ class BlockTree:
             self.maxreclen = items["maxreclen"]
 
         def getbothblocks_(self, blockno):
-            b1 = Block(self.filehandle, self.blocksize, 2 * blockno - 1)
-            b2 = Block(self.filehandle, self.blocksize, 2 * blockno)
+            b1 = Block(self.mapped_(2 * blockno - 1), self.blocksize,
+                       2 * blockno - 1)
+            b2 = Block(self.mapped_(2 * blockno), self.blocksize,
+                       2 * blockno)
             s1 = -1
             s2 = -1
             i1 = {}
@@ -136,24 +195,86 @@ class BlockTree:
                 if i2["blockno"] != blockno or s2 <= 0:
                     raise Exception(
                         "Incorrect block number in block ({}, {}, {})!"
-                        .format(i2["blockno"], blockno))
+                        .format(i2["blockno"], blockno, s2))
             return (i1, i2, s1, s2)
 
-        def readblock(self, blockno):
-            (i1, i2, s1, s2) = self.getbothblocks_(blockno)
-            if s1 > s2:
-                return i1
-            elif s2 > 0:
-                return i2
+        @classmethod
+        def peekseqno_(cls, blk):
+            # Sequence number of an unverified block, read straight
+            # from its data without parsing the block. seqno is the
+            # last entry written to a block (see makeblock_). Returns
+            # -1 if it can not be found.
+            tag = b"\nseqno = "
+            p = blk.data.rfind(tag)
+            if p < 0:
+                return -1
+            p = p + len(tag)
+            try:
+                return int(blk.data[p:blk.data.index(b"\n", p)])
+            except ValueError:
+                return -1
+
+        def cacheblock_(self, blockno, items, seqno, slot):
+            self.blockcache[blockno] = (items, seqno, slot)
+            self.blockcache.move_to_end(blockno)
+            if len(self.blockcache) > self.blockcachesize:
+                self.blockcache.popitem(last=False)
+
+        def trustblock_(self, blk, seqno):
+            # Decides if blk (with peeked sequence number seqno) is good,
+            # checking its hash if the verify option asks for it.
+            if self.verify == "sample":
+                self.readcount += 1
+                skip = (self.readcount % self.verifyinterval) != 0
             else:
-                raise Exception(
-                    "Neither primary nor backup block valid! ({}:{}:{})"
-                    .format(self.filehandle, self.blocksize, blockno)
-                )
+                skip = not self.verify
+            if skip and seqno > 0:
+                return True
+            return blk.checkhash()
 
-        def writeblock(self, blockno, items):
+        def readblock(self, blockno):
+            if blockno in self.blockcache:
+                self.blockcache.move_to_end(blockno)
+                return self.blockcache[blockno][0]
+
+            # Only the copy with the highest sequence number is
+            # verified and parsed, unless it turns out to be invalid,
+            # in which case we fall back to the other copy.
+            b1 = Block(self.mapped_(2 * blockno - 1), self.blocksize,
+                       2 * blockno - 1, verify=False)
+            b2 = Block(self.mapped_(2 * blockno), self.blocksize,
+                       2 * blockno, verify=False)
+            candidates = sorted(
+                [(self.peekseqno_(b), b) for b in [b2, b1]],
+                key=lambda x: x[0], reverse=True)
+            for (seqno, b) in candidates:
+                if self.trustblock_(b, seqno):
+                    items = b.parse()
+                    if items["blockno"] != blockno or items["seqno"] <= 0:
+                        raise Exception(
+                            "Incorrect block number in block ({}, {}, {})!"
+                            .format(items["blockno"], blockno, items["seqno"])
+                        )
+                    self.cacheblock_(blockno, items, items["seqno"], b.blkno)
+                    return items
+
+            raise Exception(
+                "Neither primary nor backup block valid! ({}:{}:{})"
+                .format(self.filehandle, self.blocksize, blockno)
+            )
+
+        def makeblock_(self, blockno, items):
+            # Builds (and hashes) the on-disk image of a block, and
+            # returns it together with the slot to write it to. The
+            # write itself is left to writeblocks_, so that several
+            # blocks can be prepared first and written in one go.
             writeboth = blockno > self.lastblock
-            if blockno <= self.lastblock:
+            if blockno in self.blockcache:
+                # Overwrite the older copy, i.e. the slot that does not
+                # hold the cached (newest) one.
+                (s0, slot) = self.blockcache[blockno][1:]
+                offset = 4*blockno - 1 - slot
+            elif blockno <= self.lastblock:
                 (i1, i2, s1, s2) = self.getbothblocks_(blockno)
                 if s1 > s2:
                     s0 = s1
@@ -164,7 +285,7 @@ class BlockTree:
                 else:
                     raise Exception(
                         "Neither primary nor backup block valid! ({}:{}:{})"
-                        .format(self.filehandle, self.blocksize, self.blockno)
+                        .format(self.filehandle, self.blocksize, blockno)
                     )
             elif blockno > self.lastblock + 1:
                 msg = \
@@ -174,17 +295,42 @@ class BlockTree:
             else:
                 s0 = 0
                 offset = 2*blockno-1
+                self.lastblock = blockno
 
             c = dict(items)
             c["seqno"] = s0 + 1
 
             b0 = Block(c, self.blocksize, blockno)
-            self.filehandle.seek(self.blocksize * offset)
-            self.filehandle.write(b0.data)
-            if writeboth:
-                self.filehandle.write(b0.data)
-                self.lastblock = blockno
-            self.filehandle.flush()
+            # Of two equal copies (writeboth), the second counts as
+            # the newest one, as in readblock and getbothblocks_.
+            newest = offset + 1 if writeboth else offset
+            self.cacheblock_(blockno, c, c["seqno"], newest)
+            return (offset, b0.data, writeboth)
+
+        def writeblocks_(self, blocks):
+            # Block images are written in slot order, and each run of
+            # consecutive slots is written with a single writev. This
+            # bypasses the buffering of filehandle (which is only used
+            # for reading the master block).
+            slots = []
+            for (offset, data, writeboth) in blocks:
+                slots.append((offset, data))
+                if writeboth:
+                    slots.append((offset + 1, data))
+            slots.sort(key=lambda x: x[0])
+
+            fd = self.filehandle.fileno()
+            start = 0
+            for i in range(1, len(slots) + 1):
+                if i == len(slots) or slots[i][0] != slots[i-1][0] + 1 \
+                   or i - start == self.writevmax:
+                    bufs = [x[1] for x in slots[start:i]]
+                    os.lseek(fd, self.blocksize * slots[start][0], os.SEEK_SET)
+                    _writeall(fd, bufs)
+                    start = i
+
+        def writeblock(self, blockno, items):
+            self.writeblocks_([self.makeblock_(blockno, items)])
 
         def setdirty(self, node):
             if self.cacheflag:
@@ -195,14 +341,52 @@ class BlockTree:
 
         def flushcache(self):
             if self.cacheflag:
-                for n in self.dirtymap:
-                    blkitems = n.blockitems()
-                    self.writeblock(n.blockno, blkitems)
+                # Hash all dirty blocks first, then write them out
+                # together. Blocks are prepared in block number order,
+                # since new blocks must be appended to the file in order.
+                nodes = sorted(self.dirtymap, key=lambda n: n.blockno)
+                blocks = []
+                for n in nodes:
+                    while n.blockno > self.lastblock + 1:
+                        # Block allocated, but abandoned by a later
+                        # split before it was ever written. Fill the
+                        # hole with an empty block.
+                        e = BlockTree.Node(self, None)
+                        e.blockno = self.lastblock + 1
+                        blocks.append(self.makeblock_(e.blockno, e.blockitems()))
+                    blocks.append(self.makeblock_(n.blockno, n.blockitems()))
+                self.writeblocks_(blocks)
                 self.dirtymap = {}
 
+        def commit(self, sync=False):
+            # Writes out pending (cached) blocks. Blocks are written
+            # straight to the operating system, so after this readers
+            # in other processes see them. With sync=True the file is
+            # also fsync'ed, to be durable on disk.
+            self.flushcache()
+            if sync:
+                os.fsync(self.filehandle.fileno())
+
+    def commit(self, sync=False):
+        self.backing.commit(sync)
+
+    def setcacheflag(self, cacheflag):
+        # Pending blocks are written out before caching is switched
+        # off, since later writes go straight to the file.
+        self.commit()
+        self.backing.cacheflag = cacheflag
+
     def flushtree(self):
+        # The tree is reloaded from disk, so pending blocks must be
+        # written first.
+        self.commit()
         self.root.flushsubtree()
         self.root = None
+        if self.backing.readonly:
+            # A reader's cached blocks may have been rewritten by the
+            # writing process since they were read. (The writer's own
+            # cache always holds what it last wrote.)
+            self.backing.blockcache.clear()
         items = self.backing.readblock(1)
         self.root = self.Node(self.backing, items)
 
@@ -224,22 +408,43 @@ class BlockTree:
         self.root.treecheck(1, loadfromdisk)
 
     class Node:
+        # Items (name,offset,size) or (name,blockno) are kept as two
+        # parallel lists: keys holds the names, and vals what they map
+        # to -- an (offset,size) tuple in leaves, and a child block
+        # number in interior nodes.
+        #
+        # The items dict a Node is created from (as returned by
+        # BlockFile.readblock) may be shared with the block cache, so
+        # it is only read here, never modified or kept. Likewise,
+        # blockitems() builds a fresh item list for each call, and
+        # makeblock_ keeps that list in the cache without copying it.
         def __init__(self, backing, items):
             self.backing = backing
             self.parent = None
+            # Index of this node's entry in parent.keys. Only valid
+            # along the path of the insert currently in progress.
+            self.parentidx = -1
             if items is None:
                 self.blockno = -1
                 self.leaf = True
-                self.items = []
+                self.keys = []
+                self.vals = []
                 self.nodeptrs = []
             else:
                 self.blockno = items["blockno"]
                 self.leaf = (items["leaf"] > 0)
-                self.items = list(items["items"])
+                self.keys = [x[0] for x in items["items"]]
                 if self.leaf:
+                    self.vals = [x[1:] for x in items["items"]]
                     self.nodeptrs = []
                 else:
-                    self.nodeptrs = [None for x in self.items]
+                    self.vals = [x[1] for x in items["items"]]
+                    self.nodeptrs = [None] * len(self.keys)
+            # Serialized size of the item list, kept up to date by
+            # setitem_ and insertitem_, so that storesize() does not
+            # have to serialize the node after every insert. Computed
+            # on first use (None until then), as readers never need it.
+            self.itembytes = None
 
         def flushsubtree(self):
             if not self.leaf:
@@ -248,18 +453,56 @@ class BlockTree:
                         self.nodeptrs[i].flushsubtree()
                         self.nodeptrs[i] = None
 
+        def itemlist(self):
+            if self.leaf:
+                return [(k,) + v for (k, v) in zip(self.keys, self.vals)]
+            else:
+                return list(zip(self.keys, self.vals))
+
         def blockitems(self):
             is_leaf = 1 if self.leaf else 0
             blkitems = {
                 "leaf":     is_leaf,
                 "blockno":  self.blockno,
-                "items":    list(self.items)
+                "items":    self.itemlist()
             }
             return blkitems
 
+        def rowsize_(self, key, val):
+            row = (key,) + val if self.leaf else (key, val)
+            return len(Block.rowbytes_(row)) + 1
+
+        def countbytes_(self):
+            return sum([
+                self.rowsize_(self.keys[i], self.vals[i])
+                for i in range(len(self.keys))
+            ])
+
+        def setitem_(self, i, key, val):
+            if self.itembytes is not None:
+                self.itembytes += self.rowsize_(key, val) - \
+                    self.rowsize_(self.keys[i], self.vals[i])
+            self.keys[i] = key
+            self.vals[i] = val
+
+        def insertitem_(self, i, key, val):
+            if self.itembytes is not None:
+                self.itembytes += self.rowsize_(key, val)
+            self.keys.insert(i, key)
+            self.vals.insert(i, val)
+
         def storesize(self):
-            blkitems = self.blockitems()
-            return Block.dataoffset + len(Block.assignstring_(blkitems))
+            # Size of the serialized blockitems(): the fixed part with
+            # an empty item list, plus the size of the items.
+            if self.itembytes is None:
+                self.itembytes = self.countbytes_()
+            head = {
+                "leaf":     1 if self.leaf else 0,
+                "blockno":  self.blockno,
+                "items":    []
+            }
+            return Block.dataoffset + len(Block.assignbytes_(head)) + \
+                self.itembytes
 
         def findroot(self):
             p = self
@@ -269,7 +512,7 @@ class BlockTree:
 
         def adjust(self):
             freespace = self.backing.blocksize - self.storesize()
-            if len(self.items) >= self.backing.maxitems or \
+            if len(self.keys) >= self.backing.maxitems or \
                freespace < self.backing.maxreclen:
                 self.split()
                 if self.parent is not None:
@@ -278,9 +521,10 @@ class BlockTree:
         def split(self):
             right = BlockTree.Node(self.backing, None)
             right.leaf = self.leaf
-            n = len(self.items)
+            n = len(self.keys)
             p = n//2
-            right.items = self.items[p:n]
+            right.keys = self.keys[p:n]
+            right.vals = self.vals[p:n]
             if not right.leaf:
                 right.nodeptrs = self.nodeptrs[p:n]
                 for x in right.nodeptrs:
@@ -297,7 +541,9 @@ class BlockTree:
             self.blockno = self.backing.allocateblock()  #++ Before, new block was not allocated
             right.blockno = right.backing.allocateblock()
 
-            del self.items[p:n]
+            del self.keys[p:n]
+            del self.vals[p:n]
+            self.itembytes = None
             if not self.leaf:
                 del self.nodeptrs[p:n]
 
@@ -314,10 +560,9 @@ class BlockTree:
 
                 root = BlockTree.Node(self.backing, None)
                 root.leaf = False
-                root.items.insert(0, (self.items[0][0], self.blockno))
-                root.items.insert(1, (right.items[0][0], right.blockno))
-                root.nodeptrs.insert(0, self)
-                root.nodeptrs.insert(1, right)
+                root.keys = [self.keys[0], right.keys[0]]
+                root.vals = [self.blockno, right.blockno]
+                root.nodeptrs = [self, right]
 
                 #++ Added consistency check
                 if oldselfblock != 1:
@@ -328,11 +573,12 @@ class BlockTree:
                 self.parent = root
                 right.parent = root
             else:
-                idx = self.parent.find(right.items[0][0])
-                self.parent.items.insert(
-                    idx,
-                    (right.items[0][0], right.blockno)
-                )
+                idx = self.parent.find(right.keys[0])
+                # This (left) node has moved to a new block too, so its
+                # entry in the parent must point there.
+                self.parent.setitem_(
+                    idx-1, self.parent.keys[idx-1], self.blockno)
+                self.parent.insertitem_(idx, right.keys[0], right.blockno)
                 self.parent.nodeptrs.insert(idx, right)
                 right.parent = self.parent
 
@@ -351,24 +597,17 @@ class BlockTree:
                 self.backing.setdirty(self.parent)  #++
 
         def find(self, key):
-            n = len(self.items)
-            if n < 8:
-                # For short lists, linear search is the fastest
-                for i in range(0, n):
-                    if key < self.items[i][0]:
-                        return i
-                return n
-            else:
-                # For longer lists, use binary search
-                a = -1
-                b = n
-                while b-a > 1:
-                    k = (a+b)//2
-                    if key < self.items[k][0]:
-                        b = k
-                    else:
-                        a = k
-                return b
+            # Index of the first item with a key larger than key.
+            return bisect.bisect_right(self.keys, key)
+
+        def child(self, i):
+            # Child node i, loaded from disk if not yet in memory.
+            if not self.nodeptrs[i]:
+                b = self.backing.readblock(self.vals[i])
+                n = BlockTree.Node(self.backing, b)
+                n.parent = self
+                self.nodeptrs[i] = n
+            return self.nodeptrs[i]
 
         def insert(self, key, value):
             idx = self.find(key)
@@ -376,7 +615,7 @@ class BlockTree:
                 dirtylist = [self]
                 owrt = False
                 if idx > 0:
-                    if self.items[idx-1][0] == key:
+                    if self.keys[idx-1] == key:
                         if self.backing.overwriteflag:
                             owrt = True
                         else:
@@ -384,106 +623,92 @@ class BlockTree:
                                 "Object ({}, {}) already in tree!"
                                 .format(str(key), str(value)))
                 else:
+                    c = self
                     p = self.parent
                     while p is not None:
                         # Walk up tree to update parent values if
                         # the first element of this node was inserted
-                        oldkey = self.items[0][0]
-                        idx2 = p.find(oldkey)
-                        p.items[idx2-1] = (key, p.items[idx2-1][1])
+                        i = c.parentidx
+                        p.setitem_(i, key, p.vals[i])
                         dirtylist.append(p)
-                        if idx2 == 1:
+                        if i == 0:
+                            c = p
                             p = p.parent
                         else:
                             break
 
-                info = (key,) + value if type(value) == tuple else (key, value)
+                info = value if type(value) == tuple else (value,)
                 if owrt:
-                    self.items[idx-1] = info
+                    self.setitem_(idx-1, key, info)
                 else:
-                    self.items.insert(idx, info)
+                    self.insertitem_(idx, key, info)
 
                 for n in dirtylist:
                     self.backing.setdirty(n)
             else:
                 if idx == 0:
                     idx = 1
-                if not self.nodeptrs[idx-1]:
-                    b = self.backing.readblock(self.items[idx-1][1])
-                    n = BlockTree.Node(self.backing, b)
-                    n.parent = self
-                    self.nodeptrs[idx-1] = n
-
-                self.nodeptrs[idx-1].insert(key, value)
+                n = self.child(idx-1)
+                n.parentidx = idx-1
+                n.insert(key, value)
 
             self.adjust()
             return self.findroot()
 
         def lookup(self, key):
-            idx = self.find(key)
+            # Walks down the tree in a loop (rather than recursively),
+            # with one bisect per level.
+            p = self
+            idx = p.find(key)
+            while idx > 0 and not p.leaf:
+                p = p.child(idx-1)
+                idx = p.find(key)
+
             if idx <= 0:
                 raise Exception("%s not found!" % str(key))
-            if self.leaf:
-                if self.items[idx-1][0] == key:
-                    # print "Lookup: ", key, self.items[idx-1][1:]
-                    return self.items[idx-1][1:]
-                else:
-                    raise Exception("%s not found (leaf)!" % str(key))
+            if p.keys[idx-1] == key:
+                # print "Lookup: ", key, p.vals[idx-1]
+                return p.vals[idx-1]
             else:
-                if not self.nodeptrs[idx-1]:
-                    b = self.backing.readblock(self.items[idx-1][1])
-                    n = BlockTree.Node(self.backing, b)
-                    n.parent = self
-                    self.nodeptrs[idx-1] = n
-                return self.nodeptrs[idx-1].lookup(key)
+                raise Exception("%s not found (leaf)!" % str(key))
 
         def last(self):
             p = self
             while p is not None and not p.leaf:
-                i = len(p.items) - 1
-                if not p.nodeptrs[i]:
-                    b = p.backing.readblock(p.items[i][1])
-                    n = BlockTree.Node(p.backing, b)
-                    n.parent = p
-                    p.nodeptrs[i] = n
-                p = p.nodeptrs[i]
+                p = p.child(len(p.keys) - 1)
 
             if p is None:
                 raise Exception("No leaf at bottom of tree!")
 
-            return p.items[-1]
+            return (p.keys[-1],) + p.vals[-1]
 
         def treecheck(self, level, loadfromdisk):
-            for i in range(1, len(self.items)):
-                if self.items[i-1] >= self.items[i]:
-                    raise Exception("Unordered!")
+            # Pairwise keys[i-1] < keys[i], without a python level loop
+            if not all(map(operator.lt, self.keys, self.keys[1:])):
+                raise Exception("Unordered!")
 
             if self.parent is not None:
-                # if len(self.items) < self.backing.maxitems/2:
+                # if len(self.keys) < self.backing.maxitems/2:
                 #    raise Exception("Item list too short")
-                idx = self.parent.find(self.items[0][0])
-                if self.parent.items[idx-1][0] != self.items[0][0]:
+                idx = self.parent.find(self.keys[0])
+                if self.parent.keys[idx-1] != self.keys[0]:
                     # print("Level = ", level)
-                    # print("items: ", self.items)
-                    # print("parent items: ", self.parent.items)
-                    # print("First item: ", self.items[0][0])
+                    # print("keys: ", self.keys)
+                    # print("parent keys: ", self.parent.keys)
+                    # print("First key: ", self.keys[0])
                     # print("Index in parent: ", idx)
                     raise Exception("Incorrect parent list (1)")
 
-                if idx < len(self.parent.items):
-                    if self.items[-1][0] >= self.parent.items[idx][0]:
+                if idx < len(self.parent.keys):
+                    if self.keys[-1] >= self.parent.keys[idx]:
                         raise Exception("Incorrect parent list (2)")
                 if self.parent.nodeptrs[idx-1] != self:
                     raise Exception("Incorrect pointer in parent")
 
             if not self.leaf:
                 if loadfromdisk:
-                    for i in range(len(self.items)):
-                        if not self.nodeptrs[i]:
-                            block = self.backing.readblock(self.items[i][1])
-                            n = BlockTree.Node(self.backing, block)
-                            n.parent = self
-                            self.nodeptrs[i] = n
+                    for i in range(len(self.keys)):
+                        self.child(i)
 
                 for x in self.nodeptrs:
                     if x:
@@ -492,23 +717,23 @@ class BlockTree:
 
 def printtree(root, s):
     if root.leaf:
-        for x in root.items:
+        for x in root.itemlist():
             print("This is x :: {}".format(str(x)))
-            print("{:.6f} -> {}".format(s, x[0], x[1]))
+            print("{} {} -> {}".format(s, x[0], x[1:]))
     else:
-        for x in root.items:
-            print("{:.6f}:".format(s, x[0]))
-            printtree(x[1], s + "    ")
+        for i in range(len(root.keys)):
+            print("{} {}:".format(s, root.keys[i]))
+            printtree(root.child(i), s + "    ")
 
 
 def printtreex(root, s):
     print(
         "%s Node with leaf = %d, %d element"
-        % (s, root.leaf, len(root.items))
+        % (s, root.leaf, len(root.keys))
     )
     if not root.leaf:
-        for x in root.items:
-            printtreex(x[1], s + "    ")
+        for i in range(len(root.keys)):
+            printtreex(root.child(i), s + "    ")
 
 
 # Main
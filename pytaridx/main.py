@@ -8,7 +8,7 @@
 ## parallel.
 from argparse import ArgumentParser, RawTextHelpFormatter
 import glob
-from multiprocessing import Pool, Manager
+from multiprocessing import Pool
 import os
 import sys
 
@@ -40,37 +40,62 @@ def setup_parser():
 
 
 def reindex_tarfiles(args):
-    pool = Pool(processes=args.nprocesses)
-    manager = Manager()
-    queue = manager.Queue()
-
+    paths = []
     for item in args.tarfiles:
         _f_path = os.path.abspath(item)
         if os.path.isfile(_f_path):
-            queue.put(item)
+            paths.append(item)
             continue
 
-        for path in glob.glob(_f_path):
-            queue.put(path)
-
-    pool.map(process_reindex, [queue for i in range(args.nprocesses)])
+        # Only patterns need to be matched against directory listings.
+        # Any other path is kept, so that processing it reports the
+        # failure.
+        if any(c in item for c in "*?["):
+            paths.extend(glob.glob(_f_path))
+        else:
+            paths.append(item)
+
+    # The list of files is known up front, so it is handed to the pool
+    # directly. Largest files go first, so that the small ones fill in
+    # at the end and the workers finish at about the same time.
+    paths.sort(key=_pathsize, reverse=True)
+
+    # Results are taken in completion order, as workers finish. Tasks
+    # are handed out one at a time; a file takes far longer to reindex
+    # than a task takes to dispatch, and bigger chunks would bunch the
+    # largest files together on one worker.
+    failures = 0
+    with Pool(processes=args.nprocesses) as pool:
+        for ok in pool.imap_unordered(process_reindex, paths, chunksize=1):
+            if not ok:
+                failures += 1
 
     print("Finished.")
+    return 0 if failures == 0 else 1
 
 
-def process_reindex(queue):
+def _pathsize(path):
+    # Size for ordering the work. Paths that can't be stat'ed (e.g.
+    # dangling links) go last, and fail (with a report) when processed.
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return -1
 
-    while not queue.empty():
-        _tar = os.path.abspath(queue.get())
-        print("Processing '%s'..." % (_tar))
 
-        try:
-            _tree = pytaridx.IndexedTarFile()
-            _tree.reindex(_tar)
-        except Exception as exep:
-            print("Failed to process '%s'." % (_tar))
-            print("Exception: %s" % (exep.msg))
-            continue
+def process_reindex(path):
+    _tar = os.path.abspath(path)
+    print("Processing '%s'..." % (_tar))
+
+    try:
+        _tree = pytaridx.IndexedTarFile()
+        _tree.reindex(_tar)
+    except Exception as exep:
+        print("Failed to process '%s'." % (_tar))
+        print("Exception: %s" % (exep,))
+        return False
+
+    return True
 
 
 def main():
@@ -66,13 +66,34 @@
 """A module containing a class for producing and reading tar archives
 with efficient indexes to allow radom (read) access."""
 
+import copy
+import io
 import tarfile
 import random
 import time
 import os
-import re
+import queue
+import threading
 
-from .blocktree import BlockTree
+from .blocktree import BlockTree, _writeall
+
+
+def _escapename(name):
+    # Escapes , (comma) and backslash (\) in member names written to
+    # the list file. Backslashes go first, so the ones added in front
+    # of commas are not escaped again.
+    if "," not in name and "\\" not in name:
+        return name
+    return name.replace("\\", "\\\\").replace(",", "\\,")
+
+
+def _lstrecord(name, offset, size):
+    # One line of the list file: escaped name, offset, and size
+    return b"%s,%d,%d\n" % (_escapename(name).encode("ASCII"), offset, size)
+
+
+# Zero padding to the end of a tar record (512 bytes)
+_ZEROPAD = bytes(512)
 
 
 class IndexNotFoundError(Exception):
@@ -83,6 +104,20 @@ class IndexedTarFile:
     """Main class that implements an API to creating, random access reading,
     writing, and re-indexing of indexed tar files."""
 
+    # Read buffer size used when scanning an archive in reindex()
+    reindexbufsize = 1 << 20
+    # Number of members handed from the archive scanner to the index
+    # builder at a time in reindex(), and the number of such batches
+    # that may be waiting
+    reindexbatchsize = 1000
+    reindexqueuelen = 16
+    # Largest gap between two members that readlist() reads through
+    # (rather than seeking over) to read both with one call
+    readlistgap = 1 << 16
+    # Largest single read readlist() merges members into. Merged reads
+    # are sliced apart, so they briefly take twice their size in memory.
+    readlistmax = 1 << 22
+
     class _IndexManager:
         """
         Index interface data structure that manages the index files, using
@@ -92,7 +127,7 @@ class IndexedTarFile:
         to quickly probe for the last member(s) added, and for fast
         re-indexing.
         """
-        def __init__(self, tarfilebasename, mode):
+        def __init__(self, tarfilebasename, mode, tree=None, lstfile=None):
             self.basename = tarfilebasename
             self.treename = self.basename + ".pytree"
             self.lstname = self.basename + ".pylst"
@@ -105,8 +140,15 @@ class IndexedTarFile:
 
             self.readonly = (mode == "r")
 
-            self.tree = BlockTree(self.treename, mode)
-            if self.readonly:
+            # An already open tree and list file (as left by reindex())
+            # can be handed over instead of being opened again.
+            if tree is None:
+                self.tree = BlockTree(self.treename, mode)
+            else:
+                self.tree = tree
+            if lstfile is not None:
+                self.lstfile = lstfile
+            elif self.readonly:
                 self.lstfile = open(self.lstname, mode + "b")
             else:
                 self.lstfile = open(self.lstname, "a+b")
@@ -118,45 +160,36 @@ class IndexedTarFile:
                 raise Exception(msg)
 
         def last(self):
-            n = 2*self.maxreclen + 1
-            f = self.lstfile
-            try:
-                f.seek(-n, os.SEEK_END)
-            except Exception:
-                f.seek(0, os.SEEK_END)
-                sz = f.tell()
-                if n > sz:
-                    n = sz
-                f.seek(sz-n, os.SEEK_SET)
-
-            data = f.read(n)
-            if f.tell() == 0:
+            # The list file is only appended to, so its tail is found
+            # from its current size and read with a single pread.
+            fd = self.lstfile.fileno()
+            sz = os.fstat(fd).st_size
+            if sz == 0:
                 return None
-
-            lines = data.splitlines()
+            n = min(2*self.maxreclen + 2, sz)
+            data = os.pread(fd, n, sz - n)
+
+            # Only newline terminated lines are whole records (a writer
+            # may be appending the last one right now), and the first
+            # line is cut off unless the tail is the whole file.
+            lines = data.split(b"\n")[:-1]
+            if n < sz:
+                lines = lines[1:]
             # print "Last lines = \n",lines
-            # Parse last line, to obtain member name and location info
-            pat = b"(\\\\.|[^,])*(,|\n)"
-            patc = re.compile(pat)
-            spat = b'\\\\(.)'
-            spatc = re.compile(spat)
-
+            # Parse last line, to obtain member name and location info.
+            # Offset and size are plain digits, so the last two commas
+            # always separate the fields; only the name carries escapes.
             foundit = False
-            for i in [-1, -2]:
-                rec = lines[i]
+            for rec in lines[:-3:-1]:
                 # print("rec = %s"%(rec,))
                 try:
-                    elems = [spatc.sub(b'\1', x.group()[:-1])
-                             for x in patc.finditer(rec + b"\n")]
-                    # print("Elems = ")
-                    # print(elems)
-                    elems[0] = elems[0].decode("ASCII")
-                    # print("elem0 = %s" %(elems[0],))
-                    for i in range(1, len(elems)):
-                        elems[i] = int(elems[i])
-                    if len(elems) == 3:
-                        foundit = True
-                        break
+                    name, offset, size = rec.rsplit(b",", 2)
+                    if b"\\" in name:
+                        name = name.replace(b"\\,", b",")
+                        name = name.replace(b"\\\\", b"\\")
+                    elems = (name.decode("ASCII"), int(offset), int(size))
+                    foundit = True
+                    break
                 except Exception:
                     # When the index package is asked to find the last member
                     # it reads the last chuck of this list file. Nearly
@@ -180,7 +213,7 @@ class IndexedTarFile:
                 raise Exception("Incorrect data at end of lstfile '%s':%s\n"
                                 % (self.lstname, data.decode("ASCII")))
 
-            return tuple(elems)
+            return elems
 
         def lookup(self, name):
             return self.tree.lookup(name)
@@ -195,45 +228,25 @@ class IndexedTarFile:
             return False
 
         def insert(self, name, offset, size):
+            self.insert_many([(name, offset, size)])
+
+        def insert_many(self, entries):
             if self.readonly:
                 msg = \
-                    "Attempting to insert (%s,%d,%d) to read-only index %s" % \
-                    (name, offset, size, self.treename)
+                    "Attempting to insert %d entries to read-only index %s" % \
+                    (len(entries), self.treename)
                 raise Exception(msg)
 
-            rec = re.compile("(,|\\\\)")
-            info = bytearray(
-                "%s,%d,%d\n" % (rec.sub(r'\\\1', name), offset, size),
-                encoding="ASCII")
+            # List file lines for the whole batch go out in one write
+            info = b"".join([_lstrecord(name, offset, size)
+                             for name, offset, size in entries])
             f = self.lstfile
             f.seek(0, os.SEEK_END)
             f.write(info)
             f.flush()
 
-            self.tree.insert(name, (offset, size))
-
-    class _IndexStruct:
-        """
-        Data structure held by tar file index, holds e.g. object size and
-        offset in tar file.
-        """
-
-        def __init__(self, offset_or_tuple, size=None):
-            """
-            Initialize a new instance of the _IndexStruct class.
-
-            :param offset: <description>
-            :param size: <description>
-            """
-            if size is None:
-                self.offset = offset_or_tuple[0]
-                self.size = offset_or_tuple[1]
-            else:
-                self.offset = offset_or_tuple
-                self.size = size
-
-        def totuple(self):
-            return (self.offset, self.size)
+            for name, offset, size in entries:
+                self.tree.insert(name, (offset, size))
 
     def __init__(self):
         """Initialize a new instance of an IndexedTarFile"""
@@ -270,30 +283,33 @@ class IndexedTarFile:
 
         if self.readonly:
             self.tfr = open(name, "rb")
-            self.tfr.seek(0, os.SEEK_END)
-            self.tfa = tarfile.open(name, "r", self.tfr, 512)
         else:
             self.tfr = open(name, "a+b")
-            # "w|" is used instead of "a", to make this work on
-            # macs. Sadly, "w|" has internal buffering, and we can't know
-            # that it gets flushed. For that reason, in write(), we write
-            # explicitly to the underlying file, while using the tarfile
-            # interface to construct the approporiate header...
-            self.tfr.seek(0, os.SEEK_END)
-            self.tfa = tarfile.open(name, "w|", self.tfr, 512)
+        # Archive data is read and appended with positioned system calls
+        # on the descriptor (see readat_() and append_()), bypassing the
+        # buffering of tfr.
+        self.tfd = self.tfr.fileno()
 
         if not haveindex:
             # print("Unable to read index, regenerating!")
             if not self.readonly:
                 self.reindex()
-                self.index = self._IndexManager(self.filename, mode)
+
+        if not self.readonly:
+            # Members are appended by writing header, data, and padding
+            # explicitly to the archive file (see write()), so nothing
+            # is left in tarfile's internal buffers after a write. The
+            # tarfile interface is only used to construct a template
+            # header (owner and permissions taken from the index file),
+            # which is copied for every new member.
+            with tarfile.open(fileobj=io.BytesIO(), mode="w") as tf:
+                self.infotemplate = tf.gettarinfo(self.index.treename)
 
         self.isopen = 1
 
     def close(self):
         """Close the tar archive and reindex the index on close."""
-        self.tfa.closed = True
-        self.tfa.close()
+        self.infotemplate = None
         self.tfr.close()
 
         self.index = None
@@ -306,45 +322,120 @@ class IndexedTarFile:
 
         :param tarfilename (optionally): Re-build the index for the
         indexed tar-file in self, or for the tar file named by
-        tarfilename if that parameter is given.
+        tarfilename if that parameter is given. In the first case the
+        new index is kept open, and used for the archive from then on.
         """
         if tarfilename is None:
-            self.tfr.seek(0)
             tarobj = self.filename
-            fp = self.tfr
         else:
             tarobj = tarfilename
-            fp = None
 
         treename = tarobj + ".pytree_"
         lstname = tarobj + ".pylst_"
         BlockTree.BlockFile.writemasterblock(treename)
-        lstfp = open(lstname, "w")
-        index = BlockTree(treename, "r+", False)
+        lstfp = open(lstname, "w+b", buffering=self.reindexbufsize)
+        # The new index is not visible to anyone until it is renamed
+        # at the end, so blocks are cached and written in groups (at
+        # each flushtree()), rather than on every insert.
+        index = BlockTree(treename, "r+", True)
         count = 0
-
-        # rec is for escaping , (comma)  and backslash (\)
-        rec = re.compile("(,|\\\\)")
+        # List file lines, written out together at each flushtree()
+        lines = []
+
+        # Archive headers are parsed by a separate thread, which hands
+        # the members over in batches. Reading the archive (which
+        # releases the GIL) then overlaps with index construction here.
+        members = queue.Queue(self.reindexqueuelen)
+        stop = threading.Event()
+        scanner = threading.Thread(target=self.scanmembers_,
+                                   args=(tarobj, members, stop))
+        scanner.start()
         try:
-            with tarfile.open(tarobj, 'r|', fp) as tf:
-                for info in tf:
+            while True:
+                batch = members.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                for name, offset, size in batch:
                     count = count + 1
-                    index.insert(info.name, (info.offset_data, info.size, ))
-                    escname = rec.sub(r'\\\1', info.name)
-                    lstfp.write("%s,%d,%d\n" %
-                                (escname, info.offset_data, info.size))
+                    index.insert(name, (offset, size, ))
+                    lines.append(_lstrecord(name, offset, size))
                     if (count % 10000) == 0:
+                        lstfp.write(b"".join(lines))
+                        lines = []
                         index.flushtree()
-        except tarfile.ReadError:
-            pass
+        except BaseException:
+            # Let the scanner finish, so that it is not left blocked on
+            # a full queue
+            stop.set()
+            while members.get() is not None:
+                pass
+            raise
+        finally:
+            scanner.join()
 
-        index.backing.flushcache()
+        lstfp.write(b"".join(lines))
         index.flushtree()
-        lstfp.close()
 
         os.rename(lstname, lstname[:-1])
         os.rename(treename, treename[:-1])
 
+        if tarfilename is None:
+            # The new index stays open as the index of this archive,
+            # with inserts written straight to the tree file.
+            index.setcacheflag(False)
+            lstfp.flush()
+            if self.readonly:
+                mode = "r"
+            else:
+                mode = "r+"
+            self.index = self._IndexManager(self.filename, mode,
+                                            index, lstfp)
+        else:
+            lstfp.close()
+
+    def scanmembers_(self, tarobj, members, stop):
+        """
+        Read the member headers of a tar archive (for reindex()).
+
+        :param tarobj: Name of the tar archive.
+        :param members: Queue receiving lists of (name, offset, size)
+         tuples, followed by None. An exception raised while reading
+         is passed on through the queue before the None.
+        :param stop: Event telling the scan to end early.
+        """
+        batch = []
+        try:
+            # The archive is read through its own handle with a large
+            # buffer, so the stream is read in few big system calls
+            # while tarfile consumes it in small records.
+            with open(tarobj, "rb", buffering=self.reindexbufsize) as fp:
+                with tarfile.open(tarobj, 'r|', fp) as tf:
+                    while True:
+                        info = tf.next()
+                        if info is None:
+                            break
+                        # next() keeps every header it reads in
+                        # tf.members, which for a large archive would
+                        # hold all of them in memory. They are not
+                        # needed again once taken into the batch.
+                        tf.members = []
+                        batch.append((info.name, info.offset_data, info.size))
+                        if len(batch) == self.reindexbatchsize:
+                            members.put(batch)
+                            batch = []
+                            if stop.is_set():
+                                break
+        except tarfile.ReadError:
+            pass
+        except Exception as e:
+            members.put(batch)
+            batch = e
+
+        members.put(batch)
+        members.put(None)
+
     def exist(self, objname):
         """
         Check if there is a file objname in the archive.
@@ -367,14 +458,9 @@ class IndexedTarFile:
          looked up in index and read from tar file. Will throw
          exception if member not found.
         """
-        objdata = self.index.lookup(objname)
-        # print "Read: ",objname,objdata
-        info = self._IndexStruct(objdata)
-        oldpos = self.tfr.tell()
-        self.tfr.seek(info.offset)
-        buf = self.tfr.read(info.size)
-        self.tfr.seek(oldpos)
-        return buf
+        offset, size = self.index.lookup(objname)
+        # print "Read: ",objname,offset,size
+        return self.readat_(offset, size)
 
     def write(self, objname, data):
         """
@@ -385,33 +471,62 @@ class IndexedTarFile:
         :param data: A buffer of data that acts like a bytes or bytearray.
                      The size should be len(data).
         """
-        oldpos = self.tfr.tell()
-        self.tfr.seek(0, os.SEEK_END)
-        offset = self.tfr.tell() + 512
+        offset = os.lseek(self.tfd, 0, os.SEEK_END)
 
+        # Add new object to tar file:
+        infobuf, pad = self.memberframe_(objname, len(data))
+        self.append_([infobuf, data, pad])
+
+        # The data follows the header, which is longer than one record
+        # when extended (pax) headers are needed.
+        self.index.insert(objname, offset + len(infobuf), len(data))
+
+    def readat_(self, offset, size):
+        """
+        Read size bytes at offset in the archive.
+
+        :param offset: Position in the archive to read from.
+        :param size: Number of bytes to read.
+        """
+        # A single pread is only short at end of file, or for reads
+        # larger than the system's limit (about 2 GB on Linux).
+        buf = os.pread(self.tfd, size, offset)
+        while 0 < len(buf) < size:
+            more = os.pread(self.tfd, size - len(buf), offset + len(buf))
+            if not more:
+                break
+            buf = buf + more
+        return buf
+
+    def append_(self, bufs):
+        """
+        Append buffers to the end of the archive.
+
+        :param bufs: List of bytes-like objects to write, in order.
+        """
+        # The archive is opened in append mode, so writes always go
+        # to the end of the file. When writev returns, the data has
+        # been handed to the operating system.
+        _writeall(self.tfd, bufs)
+
+    def memberframe_(self, objname, size):
+        """
+        Build the header and trailing padding of a new archive member.
+
+        :param objname: Name of the new member.
+        :param size: Size of the member data in bytes.
+        :returns: Tuple of header bytes and padding bytes.
+        """
         # Set name, object size, and creation/modification time of new object:
-        info = self.tfa.gettarinfo(self.index.treename)
+        info = copy.copy(self.infotemplate)
         info.name = objname
-        info.size = len(data)
+        info.size = size
         info.mtime = time.time()
 
-        # Add new object to tar file:
-        # New code, explicit write to tarfile to make sure flush()
-        # works in "w|" mode (see open()), and nothing remains in
-        # internal python/libc buffering after write returns.
-        infobuf = \
-            info.tobuf(self.tfa.format, self.tfa.encoding, self.tfa.errors)
-        self.tfr.write(infobuf)
-        self.tfr.write(data)
-        q, r = divmod(len(data), 512)
-        if r > 0:
-            pad = 512 - r
-            self.tfr.write(bytearray("\0" * pad, encoding="ASCII"))
-        # Make sure data is committed to operationg system
-        self.tfr.flush()
-        self.tfr.seek(oldpos)
-
-        self.index.insert(objname, offset, len(data))
+        infobuf = info.tobuf()
+        # Member data is padded with zeros to a whole number of records
+        r = size % 512
+        return infobuf, _ZEROPAD[:(512 - r) if r > 0 else 0]
 
     def readlist(self, namelist):
         """
@@ -420,9 +535,31 @@ class IndexedTarFile:
         :param namelist: <description>
         :returns: <description>
         """
-        objlist = []
-        for i in range(0, len(namelist)):
-            objlist.append(self.read(namelist[i]))
+        # Members are read in archive order, so that the file is read
+        # (mostly) sequentially. Members that lie close together are
+        # fetched with a single read and sliced apart.
+        infos = sorted([tuple(self.index.lookup(name)) + (i,)
+                        for i, name in enumerate(namelist)])
+        objlist = [None] * len(namelist)
+        j = 0
+        while j < len(infos):
+            start = infos[j][0]
+            end = start + infos[j][1]
+            k = j + 1
+            while k < len(infos) and infos[k][0] <= end + self.readlistgap:
+                nextend = max(end, infos[k][0] + infos[k][1])
+                if nextend - start > self.readlistmax:
+                    break
+                end = nextend
+                k = k + 1
+
+            buf = self.readat_(start, end - start)
+            if k == j + 1:
+                objlist[infos[j][2]] = buf
+            else:
+                for offset, size, i in infos[j:k]:
+                    objlist[i] = buf[(offset - start):(offset - start + size)]
+            j = k
         return objlist
 
     def writelist(self, objnamelist, datalist):
@@ -432,8 +569,28 @@ class IndexedTarFile:
         :param objnamelist: <description>
         :param datalist: <description>
         """
-        for i in range(0, len(objnamelist)):
-            self.write(objnamelist[i], datalist[i])
+        if len(objnamelist) != len(datalist):
+            raise Exception(
+                "writelist: %d names for %d data objects in archive %s"
+                % (len(objnamelist), len(datalist), self.filename))
+
+        # All members are framed into one buffer, which is appended to
+        # the archive with a single write.
+        end = os.lseek(self.tfd, 0, os.SEEK_END)
+
+        buf = bytearray()
+        entries = []
+        for objname, data in zip(objnamelist, datalist):
+            infobuf, pad = self.memberframe_(objname, len(data))
+            offset = end + len(buf) + len(infobuf)
+            entries.append((objname, offset, len(data)))
+            buf += infobuf
+            buf += data
+            buf += pad
+
+        self.append_([buf])
+
+        self.index.insert_many(entries)
 
 
 if __name__ == "__main__":
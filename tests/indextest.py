@@ -71,6 +71,34 @@ print(
     .format(t1 - t0, (t1 - t0) / nobj * 1e6)
 )
 
+print("* Writing objects with commas and backslashes in their names...")
+# Such names are escaped in the index and list files
+for name in ["x,y", "p\\,q", "back\\slash", ",lead", "trail\\"]:
+    buf = bytearray("Escaped name: {}".format(name), encoding="ASCII")
+    itf.write(name, buf)
+    objmap[name] = buf
+    lastname = name
+
+print("* Writing a list of objects...")
+# Includes an empty object, and objects that fill whole tar records
+listnames = ["list-empty", "list-512", "list-1024", "list-short"]
+listdata = [
+    bytearray(),
+    bytearray("#" * 512, encoding="ASCII"),
+    bytearray("%" * 1024, encoding="ASCII"),
+    bytearray("short", encoding="ASCII"),
+]
+itf.writelist(listnames, listdata)
+for name, buf in zip(listnames, listdata):
+    objmap[name] = buf
+lastname = listnames[-1]
+
+print("* Reopening tarfile newfile.tar...")
+# Makes lookups below go through the index as stored on disk
+itf.close()
+itf = IndexedTarFile()
+itf.open("newfile.tar","r+")
+
 print("* Reading objects...")
 t0 = time.time()
 for iter in range(0, niter):
@@ -97,8 +125,8 @@ for name in objmap:
     buf = itf.read(name)
     if buf != data:
         print("  Name = %s" % (name,))
-        print("  Data = %s" % (data.enocde("ASCII"),))
-        print("  Buf  = %s" % (buf.enocde("ASCII"),))
+        print("  Data = %s" % (data.decode("ASCII"),))
+        print("  Buf  = %s" % (buf.decode("ASCII"),))
         nfail = nfail + 1
 
 t1 = time.time()
@@ -108,6 +136,28 @@ print(
 )
 
 
+print("* Reading a list of objects...")
+# All objects, and some of them twice, in random order
+names = list(objmap) + random.sample(list(objmap), 20)
+random.shuffle(names)
+nfail = 0
+t0 = time.time()
+bufs = itf.readlist(names)
+if len(bufs) != len(names):
+    print("  Got {} objects for {} names".format(len(bufs), len(names)))
+    nfail = nfail + 1
+for name, buf in zip(names, bufs):
+    if buf != objmap[name]:
+        print("  Name = %s" % (name,))
+        nfail = nfail + 1
+
+t1 = time.time()
+print(
+    "  Reading list of {} took {:.3f} s. failcount = {}"
+    .format(len(names), t1 - t0, nfail)
+)
+
+
 print("* Checking object existence...")
 count = 0
 failcount = 0
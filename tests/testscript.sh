@@ -27,7 +27,8 @@ for v in 2 3 ; do
 	else
 	    if ( diff -q \
 	   	   <(tar tf newfile.tar) \
-		   <(sed -e 's/,.*$//' < newfile.tar.pylst) \
+		   <(sed -e 's/,[0-9]*,[0-9]*$//' -e 's/\\,/,/g' \
+			 < newfile.tar.pylst) \
 	       ) ; then
 	    
 		echo "OK"